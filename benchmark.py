@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# Utilities for measuring the throughput of ld-decode's tools.
+#
+# Running this module as a script will run some self-tests.
+
+import json
+import logging
+import math
+import os
+import socket
+import statistics
+import subprocess
+import time
+
+import scipy.stats
+
+def lddecode_revision(lddecode_dir):
+    """Return a dict describing the git revision of the ld-decode tree in
+    lddecode_dir (as try-chroma-decoder records in git-revision)."""
+
+    def git(*args):
+        return subprocess.check_output(["git", "-C", lddecode_dir] + list(args),
+                                       universal_newlines=True).rstrip()
+
+    return {
+        "commit": git("log", "-1", "--pretty=%H"),
+        "date": git("log", "-1", "--pretty=%cI"),
+        "log": git("log", "-1"),
+        }
+
+def time_command(cmd, stdin=None, cwd=None, env=None):
+    """Run cmd (a list of arguments), discarding its output, and return the
+    elapsed wall-clock time in seconds."""
+
+    if stdin is not None:
+        stdin = open(stdin, "rb")
+    try:
+        start = time.perf_counter()
+        subprocess.check_call(cmd, stdin=stdin, stdout=subprocess.DEVNULL, cwd=cwd, env=env)
+        return time.perf_counter() - start
+    finally:
+        if stdin is not None:
+            stdin.close()
+
+def confidence_interval(values, confidence=0.95):
+    """Given a list of samples, return (mean, half-width of the confidence
+    interval for the mean) using Student's t-distribution.
+
+    The half-width is 0 if there's only one sample."""
+
+    mean = statistics.mean(values)
+    if len(values) < 2:
+        return mean, 0.0
+    sem = statistics.stdev(values) / math.sqrt(len(values))
+    t = scipy.stats.t.ppf((1.0 + confidence) / 2.0, len(values) - 1)
+    return mean, t * sem
+
+class Measurement:
+    """The results of timing a command repeatedly."""
+
+    def __init__(self, name, units, times, params=None):
+        # A unique name for this measurement, used as the key when comparing
+        self.name = name
+        # The amount of work each run does (e.g. number of fields)
+        self.units = units
+        # Elapsed time for each run, in seconds
+        self.times = times
+        # Anything else worth recording about what was measured
+        self.params = params or {}
+
+    def rate(self):
+        """Return (mean, CI half-width) of the units per second."""
+
+        return confidence_interval([self.units / t for t in self.times])
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "units": self.units,
+            "times": self.times,
+            "params": self.params,
+            }
+
+    @staticmethod
+    def from_json(data):
+        return Measurement(data["name"], data["units"], data["times"], data["params"])
+
+def measure(name, cmd, units, warmup=1, repeats=5, params=None, **kwargs):
+    """Run cmd warmup times, then time it repeats times.
+    Other arguments are passed to time_command. Returns a Measurement."""
+
+    logging.info("Measuring %s", name)
+    for i in range(warmup):
+        time_command(cmd, **kwargs)
+    times = [time_command(cmd, **kwargs) for i in range(repeats)]
+
+    m = Measurement(name, units, times, params)
+    mean, ci = m.rate()
+    logging.info("%s: %.2f +/- %.2f units/s", name, mean, ci)
+    return m
+
+def write_results(filename, measurements, revision):
+    """Write a list of Measurements to a JSON results file, along with the
+    ld-decode revision and some information about this machine."""
+
+    data = {
+        "revision": revision,
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "time": time.time(),
+        "measurements": [m.to_json() for m in measurements],
+        }
+    with open(filename + ".new", "w") as f:
+        json.dump(data, f, indent=2)
+    os.rename(filename + ".new", filename)
+
+def read_results(filename):
+    """Read a JSON results file written by write_results.
+    Returns (revision, dict of name: Measurement)."""
+
+    with open(filename) as f:
+        data = json.load(f)
+    measurements = {}
+    for m_data in data["measurements"]:
+        m = Measurement.from_json(m_data)
+        measurements[m.name] = m
+    return data["revision"], measurements
+
+def compare(old, new):
+    """Compare two Measurements of the same thing. Returns (ratio of mean
+    rates, significant), where significant is True if the confidence intervals
+    of the two rates don't overlap."""
+
+    old_mean, old_ci = old.rate()
+    new_mean, new_ci = new.rate()
+    significant = ((new_mean + new_ci) < (old_mean - old_ci)
+                   or (new_mean - new_ci) > (old_mean + old_ci))
+    return new_mean / old_mean, significant
+
+if __name__ == "__main__":
+    print("Testing confidence_interval")
+    mean, ci = confidence_interval([1.0, 2.0, 3.0, 4.0, 5.0])
+    assert mean == 3.0
+    # t(0.975, 4) = 2.776, stdev = 1.581, sem = 0.707
+    assert abs(ci - 1.963) < 0.001
+    assert confidence_interval([7.0]) == (7.0, 0.0)
+
+    print("Testing compare")
+    a = Measurement("a", 100, [1.0, 1.01, 0.99])
+    b = Measurement("a", 100, [2.0, 2.02, 1.98])
+    ratio, significant = compare(a, b)
+    assert abs(ratio - 0.5) < 0.01 and significant
+    ratio, significant = compare(a, a)
+    assert ratio == 1.0 and not significant
@@ -2,9 +2,62 @@
 # Utilities for EFM decoding.
 
 import numpy as np
+import scipy.signal as sps
 
 EFM_RATE = 4321800.0
 
+# The 14-bit EFM codes corresponding to 8-bit values 0 to 255.
+# The index into this list is the value.
+EFM_VALUES = [
+    0x1220, 0x2100, 0x2420, 0x2220, 0x1100, 0x0110, 0x0420, 0x0900,
+    0x1240, 0x2040, 0x2440, 0x2240, 0x1040, 0x0040, 0x0440, 0x0840,
+    0x2020, 0x2080, 0x2480, 0x0820, 0x1080, 0x0080, 0x0480, 0x0880,
+    0x1210, 0x2010, 0x2410, 0x2210, 0x1010, 0x0210, 0x0410, 0x0810,
+    0x0020, 0x2108, 0x0220, 0x0920, 0x1108, 0x0108, 0x1020, 0x0908,
+    0x1248, 0x2048, 0x2448, 0x2248, 0x1048, 0x0048, 0x0448, 0x0848,
+    0x0100, 0x2088, 0x2488, 0x2110, 0x1088, 0x0088, 0x0488, 0x0888,
+    0x1208, 0x2008, 0x2408, 0x2208, 0x1008, 0x0208, 0x0408, 0x0808,
+    0x1224, 0x2124, 0x2424, 0x2224, 0x1124, 0x0024, 0x0424, 0x0924,
+    0x1244, 0x2044, 0x2444, 0x2244, 0x1044, 0x0044, 0x0444, 0x0844,
+    0x2024, 0x2084, 0x2484, 0x0824, 0x1084, 0x0084, 0x0484, 0x0884,
+    0x1204, 0x2004, 0x2404, 0x2204, 0x1004, 0x0204, 0x0404, 0x0804,
+    0x1222, 0x2122, 0x2422, 0x2222, 0x1122, 0x0022, 0x1024, 0x0922,
+    0x1242, 0x2042, 0x2442, 0x2242, 0x1042, 0x0042, 0x0442, 0x0842,
+    0x2022, 0x2082, 0x2482, 0x0822, 0x1082, 0x0082, 0x0482, 0x0882,
+    0x1202, 0x0248, 0x2402, 0x2202, 0x1002, 0x0202, 0x0402, 0x0802,
+    0x1221, 0x2121, 0x2421, 0x2221, 0x1121, 0x0021, 0x0421, 0x0921,
+    0x1241, 0x2041, 0x2441, 0x2241, 0x1041, 0x0041, 0x0441, 0x0841,
+    0x2021, 0x2081, 0x2481, 0x0821, 0x1081, 0x0081, 0x0481, 0x0881,
+    0x1201, 0x2090, 0x2401, 0x2201, 0x1090, 0x0201, 0x0401, 0x0890,
+    0x0221, 0x2109, 0x1110, 0x0121, 0x1109, 0x0109, 0x1021, 0x0909,
+    0x1249, 0x2049, 0x2449, 0x2249, 0x1049, 0x0049, 0x0449, 0x0849,
+    0x0120, 0x2089, 0x2489, 0x0910, 0x1089, 0x0089, 0x0489, 0x0889,
+    0x1209, 0x2009, 0x2409, 0x2209, 0x1009, 0x0209, 0x0409, 0x0809,
+    0x1120, 0x2111, 0x2490, 0x0224, 0x1111, 0x0111, 0x0490, 0x0911,
+    0x0241, 0x2101, 0x0244, 0x0240, 0x1101, 0x0101, 0x0090, 0x0901,
+    0x0124, 0x2091, 0x2491, 0x2120, 0x1091, 0x0091, 0x0491, 0x0891,
+    0x1211, 0x2011, 0x2411, 0x2211, 0x1011, 0x0211, 0x0411, 0x0811,
+    0x1102, 0x0102, 0x2112, 0x0902, 0x1112, 0x0112, 0x1022, 0x0912,
+    0x2102, 0x2104, 0x0249, 0x0242, 0x1104, 0x0104, 0x0422, 0x0904,
+    0x0122, 0x2092, 0x2492, 0x0222, 0x1092, 0x0092, 0x0492, 0x0892,
+    0x1212, 0x2012, 0x2412, 0x2212, 0x1012, 0x0212, 0x0412, 0x0812,
+    ]
+
+# Table mapping 14-bit EFM codes to values, with -1 for invalid codes
+EFM_TABLE = np.full(1 << 14, -1, np.int16)
+EFM_TABLE[EFM_VALUES] = np.arange(256)
+
+# Frame structure, in channel bits: a 24-bit sync pattern (an 11T run
+# followed by another 11T run), then 33 symbols each preceded by 3 merging
+# bits
+FRAME_BITS = 588
+MIN_T = 3
+MAX_T = 11
+SYMBOLS_PER_FRAME = 33
+SYMBOL_BITS = 14
+FIRST_SYMBOL = 27
+SYMBOL_SPACING = 17
+
 def zero_crossings(data):
     """Given a numpy array of values, return the positions of zero crossings
     within the array. Crossing positions are linearly interpolated between
@@ -22,7 +75,274 @@ def zero_crossings(data):
     # This can't divide by zero because the two must have different signs!
     return crossings[0] + ((-before) / (after - before))
 
+class EFMDecoder:
+    """Decode EFM from a stream of samples, a chunk at a time. State is carried
+    across chunks, so a long capture can be decoded without holding it all
+    in memory.
+
+    This does roughly what ld-ldstoefm and the first stage of ld-process-efm
+    do, and counts the same statistics: valid syncs, valid EFM symbols and
+    valid frames. Each stage is vectorised over the whole chunk; the PLL is
+    approximated by smoothing the period and phase estimates with
+    first-order IIR filters, rather than updating them per transition.
+
+    As in ld-process-efm, a sync pattern only counts if it's one frame away
+    from another sync, and symbols are only decoded from frames with a sync
+    at each end. Runs outside 3T-11T are invalid, and a frame can't contain
+    one, so noise shouldn't produce syncs or frames by chance."""
+
+    def __init__(self, sample_rate=40.0e6, freq_gain=0.002, phase_gain=0.1):
+        # PLL state: the current estimate of the channel bit period in
+        # samples, and the phase error in bits (raw and smoothed)
+        self.freq_coeffs = ([freq_gain], [1.0, freq_gain - 1.0])
+        self.phase_coeffs = ([phase_gain], [1.0, phase_gain - 1.0])
+        self.period = sample_rate / EFM_RATE
+        self.period_zi = sps.lfilter_zi(*self.freq_coeffs) * self.period
+        self.phase = 0.0
+        self.phase_zi = np.zeros(1)
+        self.residual = 0.0
+        # Clock phase, in bits, at the last transition
+        self.clock = 0.0
+
+        # The last sample of the previous chunk, and the position of the last
+        # transition relative to the start of this chunk
+        self.last_sample = None
+        self.last_crossing = None
+
+        # T-lengths that haven't been decoded into frames yet, and the
+        # indexes within them of syncs that have already been counted
+        self.pending = np.zeros(0, np.int64)
+        self.pending_counted = np.zeros(0, np.int64)
+
+        self.syncs = 0
+        self.symbols = 0
+        self.frames = 0
+
+    def stats(self):
+        return {
+            "syncs": self.syncs,
+            "symbols": self.symbols,
+            "frames": self.frames,
+            }
+
+    def t_lengths(self, data):
+        """Find the transitions in a chunk of samples, and return the T-length
+        (3-11) of each run that ends in this chunk, or 0 for a run that's
+        outside that range."""
+
+        if len(data) == 0:
+            return np.zeros(0, np.int64)
+        if self.last_sample is None:
+            crossings = zero_crossings(data)
+        else:
+            crossings = zero_crossings(np.concatenate(([self.last_sample], data))) - 1
+        if self.last_crossing is not None:
+            crossings = np.concatenate(([self.last_crossing], crossings))
+        self.last_sample = data[-1]
+        if len(crossings) == 0:
+            return np.zeros(0, np.int64)
+        self.last_crossing = crossings[-1] - len(data)
+        intervals = np.diff(crossings)
+        if len(intervals) == 0:
+            return np.zeros(0, np.int64)
+
+        # Frequency: estimate the period from each interval, assuming it's
+        # the nearest whole number of bits, and smooth the estimates. An
+        # interval that isn't a valid run length says nothing useful about
+        # the period, so it leaves the estimate where it was.
+        lengths = np.rint(intervals / self.period)
+        in_range = (lengths >= MIN_T) & (lengths <= MAX_T)
+        estimates = np.full(len(intervals), self.period)
+        estimates[in_range] = intervals[in_range] / lengths[in_range]
+        periods, self.period_zi = sps.lfilter(*self.freq_coeffs, estimates, zi=self.period_zi)
+        periods = np.concatenate(([self.period], periods[:-1]))
+        self.period = periods[-1]
+
+        # Phase: find the clock phase at each transition, and its error from
+        # the nearest whole number of bits (unwrapped, so it's continuous).
+        # Smooth the error, and round the corrected phase to find which bit
+        # each transition is at.
+        clock = self.clock + np.cumsum(intervals / periods)
+        residuals = np.unwrap(np.concatenate(([self.residual], clock - np.rint(clock))), period=1.0)[1:]
+        self.residual = residuals[-1]
+        errors, self.phase_zi = sps.lfilter(*self.phase_coeffs, residuals, zi=self.phase_zi)
+        errors = np.concatenate(([self.phase], errors[:-1]))
+        self.phase = errors[-1]
+        edges = np.rint(clock - errors)
+        lengths = np.diff(np.concatenate(([0.0], edges)))
+
+        # Keep the clock phase small, relative to the last transition
+        self.clock = clock[-1] - edges[-1]
+
+        lengths = lengths.astype(np.int64)
+        lengths[(lengths < MIN_T) | (lengths > MAX_T)] = 0
+        return lengths
+
+    def decode(self, data):
+        """Decode a chunk of samples. Returns (values, valid) for the frames
+        completed in this chunk: values is an (N, 33) array of decoded
+        symbols, and valid is an (N, 33) boolean array of whether each symbol
+        was a valid EFM code."""
+
+        no_frames = np.zeros((0, SYMBOLS_PER_FRAME), np.uint8), np.zeros((0, SYMBOLS_PER_FRAME), bool)
+        lengths = np.concatenate((self.pending, self.t_lengths(data)))
+
+        # Find sync patterns: two 11T runs in a row
+        syncs = np.flatnonzero((lengths[:-1] == MAX_T) & (lengths[1:] == MAX_T))
+        if len(syncs) == 0:
+            # Keep the last run, in case it's the start of a sync
+            self.pending = lengths[-1:]
+            self.pending_counted = np.zeros(0, np.int64)
+            return no_frames
+
+        # Position of each run in channel bits (invalid runs count as 0),
+        # and the number of invalid runs before each run
+        starts = np.concatenate(([0], np.cumsum(lengths)))
+        invalid_before = np.concatenate(([0], np.cumsum(lengths == 0)))
+
+        # A frame runs from one sync pattern to another exactly FRAME_BITS
+        # later, with no invalid runs in between. Any sync patterns in
+        # between (which can only be false syncs) are ignored.
+        sync_starts = starts[syncs]
+        ends = np.searchsorted(sync_starts, sync_starts + FRAME_BITS)
+        is_frame = ends < len(syncs)
+        is_frame[is_frame] = ((sync_starts[ends[is_frame]] == sync_starts[is_frame] + FRAME_BITS)
+                              & (invalid_before[syncs[ends[is_frame]]] == invalid_before[syncs[is_frame]]))
+        frame_syncs = np.flatnonzero(is_frame)
+        frame_ends = ends[frame_syncs]
+
+        # Count the syncs at either end of a frame, once each
+        accepted = np.zeros(len(syncs), bool)
+        accepted[frame_syncs] = True
+        accepted[frame_ends] = True
+        counted = np.isin(syncs, self.pending_counted)
+        self.syncs += int(np.count_nonzero(accepted & ~counted))
+        self.frames += len(frame_syncs)
+
+        # Keep everything from the first sync that could still start a frame
+        # for next time, since the sync ending that frame hasn't been seen yet
+        keep = np.flatnonzero(sync_starts + FRAME_BITS + 2 * MAX_T > starts[-1])
+        if len(keep) == 0:
+            self.pending = lengths[-1:]
+            self.pending_counted = np.zeros(0, np.int64)
+        else:
+            first = syncs[keep[0]]
+            self.pending = lengths[first:]
+            self.pending_counted = syncs[keep][(accepted | counted)[keep]] - first
+
+        if len(frame_syncs) == 0:
+            return no_frames
+
+        # Convert the runs into a bitstream, with a 1 at the start of each
+        # run, and extract all the symbols at once
+        bits = np.zeros(starts[-1] + 1, np.uint8)
+        bits[starts] = 1
+        frame_starts = sync_starts[frame_syncs]
+        offsets = (FIRST_SYMBOL + SYMBOL_SPACING * np.arange(SYMBOLS_PER_FRAME))[:, np.newaxis] + np.arange(SYMBOL_BITS)
+        symbol_bits = bits[frame_starts[:, np.newaxis, np.newaxis] + offsets]
+        codes = symbol_bits.astype(np.int64) @ (1 << np.arange(SYMBOL_BITS - 1, -1, -1))
+        values = EFM_TABLE[codes]
+        valid = values >= 0
+        self.symbols += int(np.count_nonzero(valid))
+
+        return values.astype(np.uint8), valid
+
+def decode_stream(chunks, decoder=None):
+    """Generator that decodes an iterable of sample arrays, yielding (values,
+    valid) for each chunk as EFMDecoder.decode does."""
+
+    if decoder is None:
+        decoder = EFMDecoder()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+
+def efm_stats(data, chunk_size=1 << 20, **kwargs):
+    """Decode an array of samples, returning a dictionary of statistics."""
+
+    decoder = EFMDecoder(**kwargs)
+    for values, valid in decode_stream((data[i:i + chunk_size] for i in range(0, len(data), chunk_size)),
+                                       decoder):
+        pass
+    return decoder.stats()
+
 if __name__ == "__main__":
+    print("Testing EFM_VALUES")
+    assert len(EFM_VALUES) == 256
+    assert len(set(EFM_VALUES)) == 256
+    assert all(0 < efm < (1 << 14) for efm in EFM_VALUES)
+
     print("Testing zero_crossings")
     crossings = zero_crossings(np.array([1.0, 1.0, 1.0, -1.0, -1.0, -1.0, 1.0, 1.0, 1.0, -3.0, -3.0]))
     assert np.allclose(crossings, [2.5, 5.5, 8.25])
+
+    print("Testing EFMDecoder")
+    def make_efm_bits(frames):
+        """Encode an array of frames of symbol values as channel bits,
+        choosing merging bits to keep runs between 3T and 11T."""
+        sync = [1] + [0] * 10 + [1] + [0] * 10 + [1, 0]
+        bits = []
+        zeros = 0
+        def add(code):
+            nonlocal zeros
+            for bit in code:
+                bits.append(bit)
+                zeros = 0 if bit else zeros + 1
+        def merge(next_code):
+            # Avoid 11T runs if possible, so there are no false syncs
+            lead = next_code.index(1)
+            for longest in (9, 10):
+                for merging in ([0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]):
+                    runs = "".join(map(str, [1] + [0] * zeros + merging + [0] * lead + [1])).split("1")[1:-1]
+                    if all(2 <= len(run) <= longest for run in runs):
+                        add(merging)
+                        return
+            raise ValueError("No merging bits possible")
+        for frame in frames:
+            if bits:
+                merge(sync)
+            add(sync)
+            for value in frame:
+                code = [(EFM_VALUES[value] >> (13 - i)) & 1 for i in range(14)]
+                merge(code)
+                add(code)
+        merge(sync)
+        add(sync)
+        return np.array(bits)
+
+    rng = np.random.default_rng(42)
+    frames = rng.integers(0, 256, (300, SYMBOLS_PER_FRAME))
+    bits = make_efm_bits(frames)
+
+    # Sample the NRZI waveform at 40 MHz with a slowly-varying bit rate,
+    # then lowpass filter it and add some noise
+    sample_rate = 40.0e6
+    rate = (EFM_RATE / sample_rate) * (1.0 + 0.003 * np.sin(np.arange(int(len(bits) * 9.3)) / 200000.0))
+    positions = np.cumsum(rate)
+    positions = positions[positions < len(bits)].astype(np.int64)
+    signal = np.where(np.cumsum(bits)[positions] % 2, 1.0, -1.0)
+    signal = sps.lfilter(*sps.butter(2, 2.0e6, fs=sample_rate), signal)
+    signal += rng.normal(0.0, 0.05, len(signal))
+
+    decoder = EFMDecoder(sample_rate)
+    values, valid = decoder.decode(signal)
+    assert decoder.stats() == {"syncs": 301, "symbols": 300 * 33, "frames": 300}
+    assert np.all(valid)
+    assert np.all(values == frames)
+
+    # Decoding in chunks should give the same result
+    decoder = EFMDecoder(sample_rate)
+    results = list(decode_stream((signal[i:i + 12345] for i in range(0, len(signal), 12345)), decoder))
+    assert decoder.stats() == {"syncs": 301, "symbols": 300 * 33, "frames": 300}
+    assert np.all(np.concatenate([values for values, valid in results]) == frames)
+    assert efm_stats(signal, 54321) == decoder.stats()
+    assert efm_stats(signal, 1000) == decoder.stats()
+
+    # Noise shouldn't look like EFM: out-of-range runs must not be clipped
+    # into 11T syncs
+    print("Testing EFMDecoder with noise")
+    noise = rng.normal(0.0, 1.0, int(sample_rate) // 4)
+    assert efm_stats(noise, sample_rate=sample_rate) == {"syncs": 0, "symbols": 0, "frames": 0}
+    noise = sps.lfilter(*sps.butter(2, 2.0e6, fs=sample_rate), noise)
+    assert efm_stats(noise, sample_rate=sample_rate) == {"syncs": 0, "symbols": 0, "frames": 0}
+    sine = np.sin(2 * np.pi * 50.0e3 * np.arange(int(sample_rate) // 4) / sample_rate)
+    assert efm_stats(sine, sample_rate=sample_rate) == {"syncs": 0, "symbols": 0, "frames": 0}
@@ -161,6 +161,39 @@ class FFTFilter:
         assert output_pos[0] == len(input_data)
         return output_data
 
+    def forward(self, input_data):
+        """Compute the forward FFTs of the overlapping blocks that apply() would
+        process for input_data. Returns a 2D array of complex bins, one row
+        per block, which can be passed to inverse() repeatedly to apply
+        different filters to the same input."""
+
+        # Pad with half a block of zeros at the start, and enough at the end
+        # to make the last block complete, then split into overlapping blocks
+        num_halves = -(-len(input_data) // self.half_size)
+        padded = np.zeros((num_halves + 2) * self.half_size, np.float64)
+        padded[self.half_size:self.half_size + len(input_data)] = input_data
+        blocks = np.lib.stride_tricks.sliding_window_view(padded, self.real_size)[::self.half_size]
+
+        return np.fft.rfft(blocks * self.forward_window, axis=1)
+
+    def inverse(self, blocks, freqfunc, length, dtype=np.float64):
+        """Apply a frequency-domain filter to blocks returned by forward(), and
+        return the first length samples of the result as a new numpy array of
+        type dtype. The result is the same as apply() would return.
+
+        freqfunc(comp)
+          As for apply(), but called once with a copy of all the blocks, so
+          it must work on a 2D array with one row per block."""
+
+        comp = blocks.copy()
+        freqfunc(comp)
+        output = np.fft.irfft(comp, self.real_size, axis=1)
+
+        # Overlap-add the right half of each block with the left half of the
+        # next
+        output = output[:-1, self.half_size:] + output[1:, :self.half_size]
+        return output.reshape(-1)[:length].astype(dtype)
+
 class EFMEqualiser:
     """Frequency-domain equalisation filter for the LaserDisc EFM signal.
 
@@ -179,6 +212,9 @@ class EFMEqualiser:
         self.amp = np.array([0.0, 0.2, 0.41, 0.73, 0.98, 1.03, 0.99, 0.81, 0.59, 0.42, 0.0])
         self.phase = np.array([0.0, -0.95, -1.05, -1.05, -1.2, -1.2, -1.2, -1.2, -1.2, -1.2, -1.2])
 
+        # Length of the windowed impulse response, in samples
+        self.impulse_len = 1024
+
         self.coeffs = None
 
     def compute(self, fft):
@@ -188,9 +224,10 @@ class EFMEqualiser:
         self.coeffs = np.zeros(fft.complex_size, dtype=complex)
 
         # Generate the frequency-domain coefficients by cubic interpolation between the equaliser values.
+        # Bands above the Nyquist frequency are ignored.
         a_interp = spi.interp1d(self.freqs, self.amp, kind="cubic")
         p_interp = spi.interp1d(self.freqs, self.phase, kind="cubic")
-        nonzero_bins = int(self.freqs[-1] / fft.freq_per_bin) + 1
+        nonzero_bins = min(fft.complex_size, int(self.freqs[-1] / fft.freq_per_bin) + 1)
         bin_freqs = np.arange(nonzero_bins) * fft.freq_per_bin
         bin_amp = a_interp(bin_freqs)
         bin_phase = p_interp(bin_freqs)
@@ -200,8 +237,8 @@ class EFMEqualiser:
         self.coeffs[:nonzero_bins] = bin_amp * (np.cos(bin_phase) + (complex(0, -1) * np.sin(bin_phase)))
 
         # Convert to impulse, window, and back to frequency domain
-        impulse_len = 1024
-        impulse = np.fft.irfft(self.coeffs)
+        impulse_len = min(self.impulse_len, fft.real_size)
+        impulse = np.fft.irfft(self.coeffs, fft.real_size)
         impulse = np.roll(impulse, impulse_len // 2)
         impulse[:impulse_len] *= sps.get_window('hamming', impulse_len)
         impulse[impulse_len:] = 0.0
@@ -225,6 +262,8 @@ class VideoEqualiser(EFMEqualiser):
         self.amp = np.array([1.0, 1.15, 1.3, 1.45])
         self.phase = np.array([0.0, 0.25, 0.5, 0.75])
 
+        self.impulse_len = 1024
+
         self.coeffs = None
 
 class EFMSimFilter:
@@ -311,6 +350,11 @@ if __name__ == "__main__":
         output_data = fft.apply(input_data, doublefunc)
         assert np.allclose(input_data * 2, output_data)
 
+        print("Testing FFTFilter.forward/inverse, size", size)
+        blocks = fft.forward(input_data)
+        assert np.allclose(fft.inverse(blocks, doublefunc, size), output_data)
+        assert np.allclose(fft.inverse(blocks, doublefunc, size), output_data)
+
     eq = EFMEqualiser()
     for gain in (0, 1, 2):
         print("Testing EFMEqualiser, gain", gain)
@@ -325,3 +369,4 @@ if __name__ == "__main__":
         input_data = np.sin(np.linspace(0, 4 * np.pi, 5000))
         output_data = fft.apply(input_data, eq.filter)
         assert np.allclose(input_data * gain, output_data, atol=0.1)
+        assert np.allclose(fft.inverse(fft.forward(input_data), eq.filter, len(input_data)), output_data)
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+# Reading and writing .rfz files: compressed RF samples that can be read
+# from any position without decompressing everything before it.
+#
+# An .rfz file holds 16-bit signed samples, split into fixed-size blocks.
+# Each block is delta-coded (so the slowly-changing RF signal becomes small
+# numbers), byte-shuffled (so the mostly-constant high bytes sit together),
+# then compressed with zlib. Blocks are independent, so they can be compressed
+# and decompressed in parallel, and an index at the end of the file gives the
+# position of each block.
+#
+# The file layout is:
+#   header:  MAGIC, block size in samples (uint32)
+#   blocks:  compressed data
+#   index:   end offset of each block in the file (uint64 each)
+#   trailer: number of samples (uint64), index offset (uint64), MAGIC
+# All integers are little-endian.
+#
+# Running this module as a script will run some self-tests.
+
+import collections
+import concurrent.futures
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+MAGIC = b"RFZ1"
+HEADER = struct.Struct("<4sI")
+TRAILER = struct.Struct("<QQ4s")
+
+# 256Ki samples is 6.5 ms at 40 MHz; a random read decompresses at most one
+# extra block at each end
+DEFAULT_BLOCK_SAMPLES = 1 << 18
+# Higher zlib levels are much slower, and only save a percent or two on RF
+DEFAULT_LEVEL = 1
+
+def default_threads():
+    return os.cpu_count() or 1
+
+def encode_block(samples, level=DEFAULT_LEVEL):
+    """Compress an array of int16 samples, returning bytes."""
+
+    # Differences wrap around, so decoding is exact
+    deltas = np.diff(samples.view(np.uint16), prepend=np.uint16(0))
+    shuffled = deltas.view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+def decode_block(data):
+    """Decompress bytes produced by encode_block, returning an array of int16
+    samples."""
+
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(2, -1)
+    deltas = shuffled.T.copy().view(np.uint16).reshape(-1)
+    return np.cumsum(deltas, dtype=np.uint16).view(np.int16)
+
+class RFZWriter:
+    """Write an .rfz file.
+
+    Samples can be written in pieces of any size; they are compressed in
+    parallel by a pool of threads (zlib releases the GIL), keeping a bounded
+    number of blocks in flight."""
+
+    def __init__(self, filename, block_samples=DEFAULT_BLOCK_SAMPLES,
+                 level=DEFAULT_LEVEL, threads=None):
+        self.filename = filename
+        self.block_samples = block_samples
+        self.level = level
+        self.threads = threads or default_threads()
+
+        self.f = open(filename + ".new", "wb")
+        self.f.write(HEADER.pack(MAGIC, block_samples))
+        self.offsets = []
+        self.num_samples = 0
+
+        self.pending = np.zeros(0, dtype=np.int16)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        self.futures = collections.deque()
+
+    def write(self, samples):
+        """Append an array of int16 samples."""
+
+        samples = np.asarray(samples, dtype=np.int16)
+        if len(self.pending) > 0:
+            samples = np.concatenate([self.pending, samples])
+
+        num_blocks = len(samples) // self.block_samples
+        for i in range(num_blocks):
+            block = samples[i * self.block_samples:(i + 1) * self.block_samples]
+            self.submit(block)
+        self.pending = samples[num_blocks * self.block_samples:].copy()
+
+    def submit(self, block):
+        self.futures.append(self.executor.submit(encode_block, block, self.level))
+        self.num_samples += len(block)
+        while len(self.futures) > 2 * self.threads:
+            self.write_block(self.futures.popleft().result())
+
+    def write_block(self, data):
+        self.f.write(data)
+        self.offsets.append(self.f.tell())
+
+    def close(self):
+        """Finish writing the file."""
+
+        if len(self.pending) > 0:
+            self.submit(self.pending)
+            self.pending = np.zeros(0, dtype=np.int16)
+        while self.futures:
+            self.write_block(self.futures.popleft().result())
+        self.executor.shutdown()
+
+        index_offset = self.f.tell()
+        self.f.write(np.array(self.offsets, dtype="<u8").tobytes())
+        self.f.write(TRAILER.pack(self.num_samples, index_offset, MAGIC))
+        self.f.close()
+        os.rename(self.filename + ".new", self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+            self.f.close()
+            os.unlink(self.filename + ".new")
+
+class RFZReader:
+    """Read samples from an .rfz file.
+
+    This behaves like a read-only 1D array of int16 samples: len() gives the
+    number of samples, and slicing with [start:end] returns a NumPy array, so
+    it can be used in place of an np.memmap of a .s16 file. Reads that span
+    several blocks decompress them in parallel. Recently-used blocks are
+    cached, so small reads near each other are cheap.
+
+    It's safe to read from several threads at once."""
+
+    def __init__(self, filename, threads=None, cache_blocks=8):
+        self.filename = filename
+        self.threads = threads or default_threads()
+        self.cache_blocks = cache_blocks
+
+        self.f = open(filename, "rb")
+        magic, self.block_samples = HEADER.unpack(self.f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not an .rfz file" % filename)
+
+        self.f.seek(-TRAILER.size, os.SEEK_END)
+        self.num_samples, index_offset, magic = TRAILER.unpack(self.f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is incomplete" % filename)
+
+        num_blocks = (self.num_samples + self.block_samples - 1) // self.block_samples
+        self.f.seek(index_offset)
+        ends = np.frombuffer(self.f.read(8 * num_blocks), dtype="<u8").astype(np.int64)
+        self.starts = np.concatenate([[HEADER.size], ends[:-1]])
+        self.ends = ends
+
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.executor = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("RFZReader only supports slicing")
+        indices = range(*key.indices(self.num_samples))
+        if len(indices) == 0:
+            return np.zeros(0, dtype=np.int16)
+        # Read the samples in increasing order, then step through them
+        low = min(indices[0], indices[-1])
+        high = max(indices[0], indices[-1]) + 1
+        return self.read(low, high)[indices[0] - low::indices.step]
+
+    def read_block_data(self, block):
+        with self.lock:
+            self.f.seek(self.starts[block])
+            return self.f.read(self.ends[block] - self.starts[block])
+
+    def get_block(self, block):
+        with self.lock:
+            samples = self.cache.get(block)
+            if samples is not None:
+                self.cache.move_to_end(block)
+                return samples
+
+        samples = decode_block(self.read_block_data(block))
+
+        with self.lock:
+            self.cache[block] = samples
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        return samples
+
+    def read(self, start, end):
+        """Return samples start to end as an int16 array. The result is
+        shorter than requested if end is past the end of the file."""
+
+        end = min(end, self.num_samples)
+        if start >= end:
+            return np.zeros(0, dtype=np.int16)
+
+        first_block = start // self.block_samples
+        last_block = (end - 1) // self.block_samples
+        blocks = range(first_block, last_block + 1)
+
+        if len(blocks) > 2 and self.threads > 1:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+            # Don't pollute the cache with the middle of a big read
+            parts = list(self.executor.map(lambda block: decode_block(self.read_block_data(block)),
+                                           blocks[1:-1]))
+            parts = [self.get_block(first_block)] + parts + [self.get_block(last_block)]
+        else:
+            parts = [self.get_block(block) for block in blocks]
+
+        base = first_block * self.block_samples
+        return np.concatenate(parts)[start - base:end - base]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_samples(filename):
+    """Open a file of 16-bit RF samples as an array-like object. .rfz files
+    are opened with RFZReader; anything else is assumed to be raw samples
+    (.s16) and is memory-mapped."""
+
+    if filename.endswith(".rfz"):
+        return RFZReader(filename)
+    else:
+        return np.memmap(filename=filename, dtype=np.int16, mode="r")
+
+def make_loader(filename, *args, **kwargs):
+    """Like lddecode.utils.make_loader, but also supports .rfz files.
+
+    The returned loader takes (file, sample, readlen) and returns readlen
+    samples as an int16 array, or None at the end of the file. For .rfz
+    files the file argument is ignored, since the reader has its own."""
+
+    if filename.endswith(".rfz"):
+        reader = RFZReader(filename)
+        def loader(f, sample, readlen):
+            data = reader.read(sample, sample + readlen)
+            if len(data) < readlen:
+                return None
+            return data
+        return loader
+    else:
+        import lddecode.utils
+        return lddecode.utils.make_loader(filename, *args, **kwargs)
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    rng = np.random.default_rng(42)
+
+    print("Testing encode_block/decode_block")
+    for size in (0, 1, 2, 1000):
+        samples = rng.integers(-32768, 32768, size).astype(np.int16)
+        assert np.array_equal(decode_block(encode_block(samples)), samples)
+
+    # Something RF-like: a band-limited signal plus noise, with full-scale
+    # values to check wrapping
+    num_samples = 5 * DEFAULT_BLOCK_SAMPLES + 12345
+    t = np.arange(num_samples)
+    samples = (12000 * np.sin(t * 0.37) * np.sin(t * 0.0011)
+               + rng.normal(0, 300, num_samples)).astype(np.int16)
+    samples[100] = 32767
+    samples[101] = -32768
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "test.rfz")
+
+        for block_samples in (1000, DEFAULT_BLOCK_SAMPLES):
+            print("Testing RFZWriter, block size", block_samples)
+            start_time = time.perf_counter()
+            with RFZWriter(filename, block_samples=block_samples) as writer:
+                # Write in awkward-sized pieces
+                pos = 0
+                for size in (0, 1, 999, 1000, 1001, 300000, 1):
+                    writer.write(samples[pos:pos + size])
+                    pos += size
+                writer.write(samples[pos:])
+            elapsed = time.perf_counter() - start_time
+            print("  %.1f Msamples/s, ratio %.3f"
+                  % (num_samples / elapsed / 1e6, os.path.getsize(filename) / (2 * num_samples)))
+
+            print("Testing RFZReader, block size", block_samples)
+            with RFZReader(filename) as reader:
+                assert len(reader) == num_samples
+                start_time = time.perf_counter()
+                assert np.array_equal(reader[:], samples)
+                elapsed = time.perf_counter() - start_time
+                print("  %.1f Msamples/s" % (num_samples / elapsed / 1e6))
+
+                for i in range(200):
+                    start = int(rng.integers(0, num_samples))
+                    end = start + int(rng.integers(0, 3 * block_samples))
+                    assert np.array_equal(reader[start:end], samples[start:end])
+                assert np.array_equal(reader[-10:], samples[-10:])
+                assert np.array_equal(reader[::-1], samples[::-1])
+                assert np.array_equal(reader[9000:100:-7], samples[9000:100:-7])
+                assert np.array_equal(reader[100:9000:3], samples[100:9000:3])
+                assert len(reader.read(num_samples - 5, num_samples + 5)) == 5
+                assert len(reader[num_samples:]) == 0
+
+            print("Testing make_loader, block size", block_samples)
+            loader = make_loader(filename)
+            assert np.array_equal(loader(None, 12345, 4000), samples[12345:16345])
+            assert loader(None, num_samples - 10, 20) is None
+
+        print("Testing open_samples")
+        s16_filename = os.path.join(tmpdir, "test.s16")
+        samples.tofile(s16_filename)
+        for name in (filename, s16_filename):
+            data = open_samples(name)
+            assert len(data) == num_samples
+            assert np.array_equal(data[5000:6000], samples[5000:6000])
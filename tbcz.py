@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+# Reading and writing .tbcz files: losslessly-compressed TBC video that can
+# be read a field at a time.
+#
+# Each field is compressed separately, so fields can be compressed and
+# decompressed in parallel. A TBC at 4fsc has four samples per subcarrier
+# cycle, so each sample is predicted from the previous sample plus the change
+# over the same subcarrier phase one cycle earlier:
+#   x[n-1] + x[n-4] - x[n-5]
+# This removes most of both the luma and the chroma. The residuals are
+# zigzag-coded (so small negative numbers have zero high bytes), byte-shuffled,
+# then compressed with zlib.
+#
+# The .tbcz file contains:
+#   header: MAGIC, field width, field height (uint32 each)
+#   fields: compressed data
+# and the field index is kept in a separate .tbcz.idx file, alongside the
+# usual .tbcz.json:
+#   index:  MAGIC, end offset of each field in the .tbcz file (uint64 each)
+# All integers are little-endian.
+#
+# Running this module as a script will run some self-tests.
+
+import collections
+import concurrent.futures
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+MAGIC = b"TBZ1"
+HEADER = struct.Struct("<4sII")
+
+# Higher zlib levels are much slower, and save little on the residuals
+DEFAULT_LEVEL = 1
+
+def default_threads():
+    return os.cpu_count() or 1
+
+def predict_residuals(samples):
+    """Return the prediction residuals for a 1D uint16 array."""
+
+    # x[n] - (x[n-1] + x[n-4] - x[n-5]) is the first difference minus the
+    # first difference four samples earlier. Arithmetic wraps around, so
+    # decoding is exact.
+    diffs = np.diff(samples, prepend=np.uint16(0))
+    residuals = diffs.copy()
+    residuals[4:] -= diffs[:-4]
+    return residuals
+
+def unpredict_residuals(residuals):
+    """Invert predict_residuals."""
+
+    # Undo each difference with a cumulative sum: first with stride 4, then
+    # with stride 1
+    count = len(residuals)
+    padded = np.zeros((count + 3) // 4 * 4, dtype=np.uint16)
+    padded[:count] = residuals
+    diffs = np.cumsum(padded.reshape(-1, 4), axis=0, dtype=np.uint16).reshape(-1)[:count]
+    return np.cumsum(diffs, dtype=np.uint16)
+
+def encode_field(field, level=DEFAULT_LEVEL):
+    """Compress a field (an array of uint16 samples), returning bytes."""
+
+    residuals = predict_residuals(np.ascontiguousarray(field, dtype=np.uint16).reshape(-1))
+    signed = residuals.view(np.int16)
+    zigzag = ((signed << 1) ^ (signed >> 15)).view(np.uint16)
+    shuffled = zigzag.view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+def decode_field(data, width, height):
+    """Decompress bytes produced by encode_field, returning a (height, width)
+    array of uint16 samples."""
+
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(2, -1)
+    zigzag = shuffled.T.copy().view(np.uint16).reshape(-1)
+    residuals = (zigzag >> 1) ^ (-(zigzag & 1)).astype(np.uint16)
+    return unpredict_residuals(residuals).reshape(height, width)
+
+def read_slice(reader, key):
+    """Return a slice of a reader's fields, using its read method."""
+
+    indices = range(*key.indices(len(reader)))
+    if len(indices) == 0:
+        return reader.read(0, 0)
+    # Read the fields in increasing order, then step through them
+    low = min(indices[0], indices[-1])
+    high = max(indices[0], indices[-1]) + 1
+    return reader.read(low, high)[indices[0] - low::indices.step]
+
+class TBCZWriter:
+    """Write a .tbcz file.
+
+    Fields are compressed in parallel by a pool of threads, keeping a bounded
+    number in flight. The .tbcz and .tbcz.idx files appear when the writer is
+    closed."""
+
+    def __init__(self, filename, width, height, level=DEFAULT_LEVEL, threads=None):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.level = level
+        self.threads = threads or default_threads()
+
+        self.f = open(filename + ".new", "wb")
+        self.f.write(HEADER.pack(MAGIC, width, height))
+        self.offsets = []
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        self.futures = collections.deque()
+
+    def write_field(self, field):
+        """Append a field: an array or bytes of width * height uint16
+        samples."""
+
+        if isinstance(field, (bytes, bytearray)):
+            field = np.frombuffer(field, dtype=np.uint16)
+        field = np.asarray(field, dtype=np.uint16)
+        if field.size != self.width * self.height:
+            raise ValueError("Field has %d samples, expected %d" % (field.size, self.width * self.height))
+
+        self.futures.append(self.executor.submit(encode_field, field, self.level))
+        while len(self.futures) > 2 * self.threads:
+            self.write_data(self.futures.popleft().result())
+
+    def write_data(self, data):
+        self.f.write(data)
+        self.offsets.append(self.f.tell())
+
+    def close(self):
+        """Finish writing the file."""
+
+        while self.futures:
+            self.write_data(self.futures.popleft().result())
+        self.executor.shutdown()
+        self.f.close()
+
+        with open(self.filename + ".idx.new", "wb") as f:
+            f.write(MAGIC)
+            f.write(np.array(self.offsets, dtype="<u8").tobytes())
+        os.rename(self.filename + ".new", self.filename)
+        os.rename(self.filename + ".idx.new", self.filename + ".idx")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+            self.f.close()
+            os.unlink(self.filename + ".new")
+
+class TBCZReader:
+    """Read fields from a .tbcz file.
+
+    This behaves like a read-only array of fields: len() gives the number of
+    fields, [n] returns field n (counting from 0) as a (height, width) uint16
+    array, and [start:end] returns a 3D array. Reads of several fields
+    decompress them in parallel.
+
+    It's safe to read from several threads at once."""
+
+    def __init__(self, filename, threads=None):
+        self.filename = filename
+        self.threads = threads or default_threads()
+
+        with open(filename + ".idx", "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s.idx is not a .tbcz index" % filename)
+            ends = np.frombuffer(f.read(), dtype="<u8").astype(np.int64)
+
+        self.f = open(filename, "rb")
+        magic, self.width, self.height = HEADER.unpack(self.f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a .tbcz file" % filename)
+        self.field_size = self.width * self.height
+
+        self.starts = np.concatenate([[HEADER.size], ends[:-1]]).astype(np.int64)
+        self.ends = ends
+
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return read_slice(self, key)
+        index = key.__index__()
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("field %d out of range" % key)
+        return self.read_field(index)
+
+    def read_field(self, index):
+        """Return field index (counting from 0) as a (height, width) uint16
+        array."""
+
+        data = os.pread(self.f.fileno(), self.ends[index] - self.starts[index],
+                        self.starts[index])
+        return decode_field(data, self.width, self.height)
+
+    def iter_fields(self, start=0, end=None):
+        """Yield fields start to end, decompressing ahead in parallel."""
+
+        if end is None or end > len(self):
+            end = len(self)
+        if self.threads == 1:
+            for index in range(start, end):
+                yield self.read_field(index)
+            return
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        futures = collections.deque()
+        index = start
+        while index < end or futures:
+            while index < end and len(futures) < 2 * self.threads:
+                futures.append(self.executor.submit(self.read_field, index))
+                index += 1
+            yield futures.popleft().result()
+
+    def read(self, start, end):
+        """Return fields start to end as a (fields, height, width) uint16
+        array. The result is shorter than requested if end is past the end of
+        the file."""
+
+        end = min(end, len(self))
+        fields = np.zeros((max(0, end - start), self.height, self.width), dtype=np.uint16)
+        for i, field in enumerate(self.iter_fields(start, end)):
+            fields[i] = field
+        return fields
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class RawTBCReader:
+    """Read fields from an uncompressed .tbc file, with the same interface as
+    TBCZReader.
+
+    The file is read afresh each time, so this works on a file that's still
+    being written."""
+
+    def __init__(self, filename, width, height):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.field_size = width * height
+
+        self.f = open(filename, "rb")
+
+    def __len__(self):
+        return os.fstat(self.f.fileno()).st_size // (2 * self.field_size)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return read_slice(self, key)
+        index = key.__index__()
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("field %d out of range" % key)
+        return self.read_field(index)
+
+    def read_field(self, index):
+        field_bytes = 2 * self.field_size
+        data = os.pread(self.f.fileno(), field_bytes, field_bytes * index)
+        if len(data) != field_bytes:
+            raise IndexError("field %d out of range" % index)
+        return np.frombuffer(data, dtype=np.uint16).reshape(self.height, self.width)
+
+    def iter_fields(self, start=0, end=None):
+        if end is None or end > len(self):
+            end = len(self)
+        for index in range(start, end):
+            yield self.read_field(index)
+
+    def read(self, start, end):
+        end = min(end, len(self))
+        field_bytes = 2 * self.field_size
+        data = os.pread(self.f.fileno(), field_bytes * max(0, end - start), field_bytes * start)
+        return np.frombuffer(data, dtype=np.uint16).reshape(-1, self.height, self.width)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_tbc(filename, width=None, height=None, threads=None):
+    """Open a .tbc or .tbcz file for reading fields. For .tbc files, the
+    field size must be given (from the video parameters in the JSON)."""
+
+    if filename.endswith(".tbcz"):
+        return TBCZReader(filename, threads=threads)
+    else:
+        if width is None or height is None:
+            raise ValueError("Field size needed to read " + filename)
+        return RawTBCReader(filename, width, height)
+
+def open_tbc_json(filename, video_params, threads=None):
+    """Like open_tbc, taking the field size from a JSON videoParameters
+    dict."""
+
+    return open_tbc(filename, video_params["fieldWidth"], video_params["fieldHeight"],
+                    threads=threads)
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    rng = np.random.default_rng(42)
+
+    print("Testing predict_residuals/unpredict_residuals")
+    for size in (0, 1, 3, 4, 5, 1000, 1001):
+        samples = rng.integers(0, 65536, size).astype(np.uint16)
+        assert np.array_equal(unpredict_residuals(predict_residuals(samples)), samples)
+
+    # Something TBC-like: a PAL field with a luma ramp, a 4fsc subcarrier,
+    # noise, and some extreme values to check wrapping
+    width, height = 1135, 313
+    num_fields = 20
+    t = np.arange(width * height)
+    fields = []
+    for i in range(num_fields):
+        field = (16384 + 20000 * ((t % width) / width) + 8000 * np.sin(t * np.pi / 2 + i)
+                 + rng.normal(0, 200, len(t))).clip(0, 65535).astype(np.uint16)
+        field[i] = 0
+        field[i + 1] = 65535
+        fields.append(field.reshape(height, width))
+    fields = np.array(fields)
+
+    print("Testing encode_field/decode_field")
+    for field in fields[:3]:
+        assert np.array_equal(decode_field(encode_field(field), width, height), field)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "test.tbcz")
+
+        print("Testing TBCZWriter")
+        start_time = time.perf_counter()
+        with TBCZWriter(filename, width, height) as writer:
+            for field in fields[:-1]:
+                writer.write_field(field)
+            writer.write_field(fields[-1].tobytes())
+        elapsed = time.perf_counter() - start_time
+        print("  %.1f fields/s, ratio %.3f"
+              % (num_fields / elapsed, os.path.getsize(filename) / fields.nbytes))
+
+        print("Testing TBCZReader")
+        with TBCZReader(filename) as reader:
+            assert len(reader) == num_fields
+            start_time = time.perf_counter()
+            assert np.array_equal(reader[:], fields)
+            elapsed = time.perf_counter() - start_time
+            print("  %.1f fields/s" % (num_fields / elapsed))
+
+            assert np.array_equal(reader[7], fields[7])
+            assert np.array_equal(reader[-1], fields[-1])
+            assert np.array_equal(reader[3:9], fields[3:9])
+            assert np.array_equal(reader[::-1], fields[::-1])
+            assert np.array_equal(reader[12:2:-3], fields[12:2:-3])
+            assert len(reader[num_fields:]) == 0
+            assert np.array_equal(np.array(list(reader.iter_fields(15))), fields[15:])
+
+        print("Testing RawTBCReader")
+        tbc_filename = os.path.join(tmpdir, "test.tbc")
+        fields.tofile(tbc_filename)
+        with open_tbc(tbc_filename, width, height) as reader:
+            assert len(reader) == num_fields
+            assert np.array_equal(reader[:], fields)
+            assert np.array_equal(reader[5], fields[5])
+            assert np.array_equal(reader[2:4], fields[2:4])
+            assert np.array_equal(reader[::-2], fields[::-2])
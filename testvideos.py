@@ -6,17 +6,25 @@
 # XXX There's a lot of duplication between the ffmpeg commands...
 # XXX mobcal looks quite different from the BBC copy
 
+import collections
+import hashlib
+import json
 import logging
+import math
 import os
+import random
+import shutil
 import statistics
 import subprocess
 import sys
+import tempfile
 
 testsuite_dir = os.path.realpath(os.path.dirname(sys.argv[0]))
 lddecode_dir = os.path.join(testsuite_dir, "..", "ld-decode")
 
 cache_dir = os.path.join(testsuite_dir, "cache", "evaluate")
 video_dir = os.path.join(cache_dir, "video")
+sampled_dir = os.path.join(cache_dir, "sampled")
 tmp_dir = "/var/tmp/lddtest/evaluate"
 
 # System parameters for interpolating into commands.
@@ -37,6 +45,13 @@ for params in PARAMS.values():
     params["pad"] = params["size"].replace("x", ":")
     params["scale"] = params["active"].replace("x", ":")
 
+# Length of the colour subcarrier sequence in fields. Subsets of a testcase
+# are made from whole sequences so the sequence stays intact.
+SEQUENCE_FIELDS = {
+    "NTSC": 4,
+    "PAL": 8,
+}
+
 # Common args for ffmpeg.
 FFMPEG = [
     "ffmpeg",
@@ -234,12 +249,25 @@ def parse_ffmpeg_stats(filename, want_key):
                     values.append(float(parts[1]))
     return values
 
-def evaluate(testcase, decoder_args):
-    """Decode testcase using ld-chroma-decoder with the given args, compare the
-    results to the original video, and return (mean PSNR, mean SSIM)."""
+def compare_decoded(testcase, decoder_args, tbcname, rgbname):
+    """Decode tbcname using ld-chroma-decoder with the given args, compare the
+    results to rgbname, and return (list of PSNRs, list of SSIMs) with one
+    value per frame."""
 
+    # Several evaluations of the same testcase may be running at once (e.g.
+    # workers on the same machine), so each needs its own stats files
     os.makedirs(tmp_dir, exist_ok=True)
-    outprefix = os.path.join(tmp_dir, testcase.name + ".out")
+    run_dir = tempfile.mkdtemp(dir=tmp_dir, prefix=testcase.name + ".")
+    try:
+        return compare_decoded_in(testcase, decoder_args, tbcname, rgbname,
+                                  os.path.join(run_dir, "out"))
+    finally:
+        shutil.rmtree(run_dir)
+
+def compare_decoded_in(testcase, decoder_args, tbcname, rgbname, outprefix):
+    """Implementation of compare_decoded, writing ffmpeg's stats files to
+    outprefix.psnr and outprefix.ssim."""
+
     params = PARAMS[testcase.system]
 
     # Start ld-chroma-decoder with output to a pipe
@@ -248,7 +276,7 @@ def evaluate(testcase, decoder_args):
         "--quiet",
         "--chroma-gain", "1.0",
         ] + decoder_args + [
-        testcase.tbcname, # output to stdout
+        tbcname, # output to stdout
         ]
     decoder_proc = subprocess.Popen(decoder_cmd, stdout=subprocess.PIPE)
 
@@ -257,16 +285,16 @@ def evaluate(testcase, decoder_args):
     # The values returned may be "inf" if the output is identical to the input...
     psnrname = outprefix + ".psnr"
     ssimname = outprefix + ".ssim"
-    ffmpeg_command = FFMPEG + [
+    ffmpeg_cmd = FFMPEG + [
         "-f", "rawvideo", "-pix_fmt", "rgb48",
         "-s", params["size"], "-i", "-",
         "-f", "rawvideo", "-pix_fmt", "rgb48",
-        "-s", params["size"], "-i", testcase.rgbname,
+        "-s", params["size"], "-i", rgbname,
         "-lavfi", "[0:v][1:v]psnr=stats_file=%s; [0:v][1:v]ssim=stats_file=%s"
             % (psnrname, ssimname),
         "-f", "null", "-",
         ]
-    ffmpeg_proc = subprocess.Popen(ffmpeg_command, stdin=decoder_proc.stdout)
+    ffmpeg_proc = subprocess.Popen(ffmpeg_cmd, stdin=decoder_proc.stdout)
 
     # Wait for the two processes to finish
     rc = decoder_proc.wait()
@@ -278,11 +306,152 @@ def evaluate(testcase, decoder_args):
 
     # Read the per-frame stats back from ffmpeg
     psnrs = parse_ffmpeg_stats(psnrname, "psnr_avg")
-    psnr = statistics.mean(psnrs)
     ssims = parse_ffmpeg_stats(ssimname, "All")
-    ssim = statistics.mean(ssims)
 
-    return psnr, ssim
+    return psnrs, ssims
+
+def evaluate(testcase, decoder_args):
+    """Decode testcase using ld-chroma-decoder with the given args, compare the
+    results to the original video, and return (mean PSNR, mean SSIM)."""
+
+    psnrs, ssims = compare_decoded(testcase, decoder_args, testcase.tbcname, testcase.rgbname)
+    return statistics.mean(psnrs), statistics.mean(ssims)
+
+def sample_testcase(testcase, fidelity):
+    """Cut a subset of testcase's sequences, for evaluate_sampled.
+
+    The sequences are split into equal strata, and one sequence is chosen
+    from each (deterministically, so the same subset is used every time).
+    Each chosen sequence is kept along with the sequences either side of it,
+    so the decoder sees the same fields around it as it would in the whole
+    testcase. The subset .tbc, .tbc.json and .rgb are cached, keyed on the
+    size and modification time of the testcase's files.
+
+    Return (tbcname, rgbname, list of lists of frame numbers in the subset
+    for each chosen sequence, total number of sequences)."""
+
+    with open(testcase.tbcname + ".json") as f:
+        tbc_json = json.load(f)
+    video_params = tbc_json["videoParameters"]
+    field_bytes = 2 * video_params["fieldWidth"] * video_params["fieldHeight"]
+    width, height = map(int, PARAMS[testcase.system]["size"].split("x"))
+    frame_bytes = 6 * width * height
+
+    # The last sequence may be incomplete. Only whole frames are compared,
+    # so ignore a trailing odd field, which would otherwise make a sequence
+    # with no frames.
+    seq_fields = SEQUENCE_FIELDS[testcase.system]
+    num_fields = 2 * (len(tbc_json["fields"]) // 2)
+    num_seqs = (num_fields + seq_fields - 1) // seq_fields
+    def seq_range(seq):
+        return seq * seq_fields, min(num_fields, (seq + 1) * seq_fields)
+
+    num_chosen = max(1, min(num_seqs, int(round(fidelity * num_seqs))))
+    if num_chosen == num_seqs:
+        # Nothing to cut
+        return (testcase.tbcname, testcase.rgbname,
+                [list(range(first // 2, last // 2)) for first, last in map(seq_range, range(num_seqs))],
+                num_seqs)
+
+    rng = random.Random("%s/%d" % (testcase.name, num_chosen))
+    chosen = [rng.randrange((i * num_seqs) // num_chosen, ((i + 1) * num_seqs) // num_chosen)
+              for i in range(num_chosen)]
+    keep = sorted(set(seq for c in chosen for seq in (c - 1, c, c + 1)
+                      if seq >= 0 and seq < num_seqs))
+
+    # Work out where the chosen sequences' frames end up in the subset
+    chosen_frames = []
+    out_frame = 0
+    for seq in keep:
+        first, last = seq_range(seq)
+        num_frames = (last - first) // 2
+        if seq in chosen:
+            chosen_frames.append(list(range(out_frame, out_frame + num_frames)))
+        out_frame += num_frames
+
+    # Regenerating the testcase must invalidate the subset
+    h = hashlib.sha256()
+    for filename in (testcase.tbcname, testcase.tbcname + ".json", testcase.rgbname):
+        st = os.stat(filename)
+        h.update(("%d %d\n" % (st.st_size, st.st_mtime_ns)).encode("UTF-8"))
+    base = "%s.%dof%d." % (testcase.name, num_chosen, num_seqs)
+    prefix = os.path.join(sampled_dir, base + h.hexdigest()[:12])
+    tbcname = prefix + ".tbc"
+    rgbname = prefix + ".rgb"
+    if os.path.exists(rgbname):
+        return tbcname, rgbname, chosen_frames, num_seqs
+
+    logging.info("Cutting %d of %d sequences from %s", num_chosen, num_seqs, testcase.name)
+    os.makedirs(sampled_dir, exist_ok=True)
+
+    # Remove any subsets of an older version of the testcase
+    for filename in os.listdir(sampled_dir):
+        if filename.startswith(base) and not filename.startswith(os.path.basename(prefix)):
+            os.unlink(os.path.join(sampled_dir, filename))
+
+    # Copy the kept fields and frames, seeking past the others
+    out_fields = []
+    with open(testcase.tbcname, "rb") as tbc_in, open(tbcname + ".new", "wb") as tbc_out, \
+         open(testcase.rgbname, "rb") as rgb_in, open(rgbname + ".new", "wb") as rgb_out:
+        for seq in keep:
+            first, last = seq_range(seq)
+            tbc_in.seek(first * field_bytes)
+            tbc_out.write(tbc_in.read((last - first) * field_bytes))
+            rgb_in.seek((first // 2) * frame_bytes)
+            rgb_out.write(rgb_in.read(((last - first) // 2) * frame_bytes))
+
+            for field in tbc_json["fields"][first:last]:
+                field = field.copy()
+                field["seqNo"] = len(out_fields) + 1
+                out_fields.append(field)
+
+    tbc_json["fields"] = out_fields
+    video_params["numberOfSequentialFields"] = len(out_fields)
+    with open(tbcname + ".json.new", "w") as f:
+        json.dump(tbc_json, f)
+
+    # The .rgb is renamed last, so its presence means the subset is complete
+    os.rename(tbcname + ".new", tbcname)
+    os.rename(tbcname + ".json.new", tbcname + ".json")
+    os.rename(rgbname + ".new", rgbname)
+
+    return tbcname, rgbname, chosen_frames, num_seqs
+
+SampledResult = collections.namedtuple("SampledResult", ["psnr", "psnr_ci", "ssim", "ssim_ci"])
+
+def evaluate_sampled(testcase, decoder_args, fidelity=1.0):
+    """Like evaluate, but only decode a fraction fidelity (0.0-1.0) of
+    testcase's sequences, chosen by sample_testcase.
+
+    Return a SampledResult with the mean PSNR and SSIM and the half-widths of
+    their 95% confidence intervals, treating each sequence as a sample from
+    the whole testcase. With fidelity=1.0, the means are the same as evaluate
+    returns, and the intervals are 0."""
+
+    # Imported here so that using the testcases doesn't need scipy
+    from benchmark import confidence_interval
+
+    tbcname, rgbname, chosen_frames, num_seqs = sample_testcase(testcase, fidelity)
+    psnrs, ssims = compare_decoded(testcase, decoder_args, tbcname, rgbname)
+
+    # Finite population correction, since we're sampling without replacement
+    if num_seqs > 1:
+        fpc = math.sqrt((num_seqs - len(chosen_frames)) / (num_seqs - 1))
+    else:
+        fpc = 0.0
+
+    results = []
+    for values in (psnrs, ssims):
+        # Weight each sequence by its number of frames, so the means match
+        # evaluate's when all the frames are used
+        frames = [frame for seq_frames in chosen_frames for frame in seq_frames]
+        mean = statistics.mean(values[frame] for frame in frames)
+        seq_means = [statistics.mean(values[frame] for frame in seq_frames)
+                     for seq_frames in chosen_frames]
+        ci = confidence_interval(seq_means)[1] * fpc
+        results += [mean, ci]
+
+    return SampledResult(*results)
 
 def get_testcases():
     """Ensure all the testcases have been generated, and return a dict of them."""
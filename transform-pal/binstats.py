@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# Histograms of the bin statistics produced by ld-chroma-decoder with
+# binstats.diff applied, for calibrating the Transform PAL thresholds.
+#
+# The patched decoder writes a record for each FFT it filters, containing
+# the squared magnitudes of each bin and its reflection. Decoding the same
+# video as composite, luma only and chroma only gives three files with
+# matching records. calibrate-bins reads those files directly, but they're
+# enormous, and have to be reread for every refinement of the thresholds.
+#
+# Instead, for each bin, a histogram records how much luma and chroma energy
+# was seen at each ratio between the composite bin and its reflection. The
+# decoder treats a bin as luma if that ratio is below the threshold, so the
+# histograms are enough to find the threshold with the least misclassified
+# energy, to the resolution of the histogram. Histograms from different
+# testcases can be merged by adding them.
+#
+# Running this module as a script will run some self-tests.
+
+import os
+
+import numpy as np
+
+# Bin layouts (x, y, z) for each decoder
+BIN_SHAPES = {
+    "2d": (5, 16, 1),
+    "3d": (3, 32, 8),
+}
+
+# Resolution of the ratio histograms
+LEVELS = 1000
+
+# Records to process at once
+CHUNK_RECORDS = 1000
+
+class BinHistogram:
+    """Per-bin histograms of luma and chroma energy against composite
+    magnitude ratio."""
+
+    def __init__(self, dim, testcases=()):
+        self.dim = dim
+        self.bins_x, self.bins_y, self.bins_z = BIN_SHAPES[dim]
+        self.num_bins = self.bins_x * self.bins_y * self.bins_z
+
+        # Testcases included in the histograms
+        self.testcases = sorted(testcases)
+        # Number of records for each ratio level
+        self.counts = np.zeros((self.num_bins, LEVELS), dtype=np.uint64)
+        # Luma and chroma magnitude (value + reflection) for each ratio level
+        self.luma = np.zeros((self.num_bins, LEVELS), dtype=np.float64)
+        self.chroma = np.zeros((self.num_bins, LEVELS), dtype=np.float64)
+        # Composite magnitude (value + reflection) for each bin
+        self.amp = np.zeros(self.num_bins, dtype=np.float64)
+        self.records = 0
+
+    def add_records(self, comp, luma, chroma):
+        """Add records from the three decodes. Each argument is an array of
+        shape (records, num_bins, 2) of squared magnitudes."""
+
+        comp_mag = np.sqrt(comp.astype(np.float64))
+        luma_mag = np.sqrt(luma.astype(np.float64)).sum(axis=2)
+        chroma_mag = np.sqrt(chroma.astype(np.float64)).sum(axis=2)
+
+        # The ratio is always <= 1, and a bin with no energy in either
+        # half is treated as chroma
+        low = comp_mag.min(axis=2)
+        high = comp_mag.max(axis=2)
+        ratio = np.divide(low, high, out=np.ones_like(low), where=(high > 0))
+        levels = np.minimum((ratio * LEVELS).astype(np.int64), LEVELS - 1)
+
+        # Accumulate all the bins at once by giving each (bin, level) pair
+        # its own index
+        index = (levels + np.arange(self.num_bins) * LEVELS).reshape(-1)
+        size = self.num_bins * LEVELS
+        self.counts += np.bincount(index, minlength=size).reshape(self.num_bins, LEVELS).astype(np.uint64)
+        self.luma += np.bincount(index, luma_mag.reshape(-1), size).reshape(self.num_bins, LEVELS)
+        self.chroma += np.bincount(index, chroma_mag.reshape(-1), size).reshape(self.num_bins, LEVELS)
+        self.amp += comp_mag.sum(axis=(0, 2))
+        self.records += len(comp)
+
+    def add_files(self, comp_filename, luma_filename, chroma_filename):
+        """Add records from three binstats files."""
+
+        record_size = self.num_bins * 2
+        files = [np.memmap(filename, dtype=np.float32, mode="r")
+                 for filename in (comp_filename, luma_filename, chroma_filename)]
+        num_records = min(len(f) // record_size for f in files)
+
+        for start in range(0, num_records, CHUNK_RECORDS):
+            end = min(num_records, start + CHUNK_RECORDS)
+            self.add_records(*[f[start * record_size:end * record_size].reshape(-1, self.num_bins, 2)
+                               for f in files])
+
+    def merge(self, other):
+        """Add the histograms from another BinHistogram."""
+
+        if other.dim != self.dim:
+            raise ValueError("Can't merge %s and %s histograms" % (self.dim, other.dim))
+        overlap = set(self.testcases) & set(other.testcases)
+        if overlap:
+            raise ValueError("Testcases already included: " + " ".join(sorted(overlap)))
+
+        self.testcases = sorted(self.testcases + other.testcases)
+        self.counts += other.counts
+        self.luma += other.luma
+        self.chroma += other.chroma
+        self.amp += other.amp
+        self.records += other.records
+
+    def best_thresholds(self):
+        """Find the threshold for each bin that misclassifies the least
+        energy, preferring lower thresholds where otherwise equal. Return
+        (thresholds, correct fraction) arrays."""
+
+        # With threshold k / LEVELS, levels below k are treated as luma, and
+        # the rest as chroma
+        zero = np.zeros((self.num_bins, 1))
+        luma_below = np.concatenate([zero, np.cumsum(self.luma, axis=1)], axis=1)
+        chroma_below = np.concatenate([zero, np.cumsum(self.chroma, axis=1)], axis=1)
+        luma_total = luma_below[:, -1:]
+        chroma_total = chroma_below[:, -1:]
+
+        incorrect = chroma_below + (luma_total - luma_below)
+        best = np.argmin(incorrect, axis=1)
+
+        total = (luma_total + chroma_total)[:, 0]
+        best_incorrect = incorrect[np.arange(self.num_bins), best]
+        correct = np.divide(total - best_incorrect, total, out=np.ones_like(total), where=(total > 0))
+        return best / LEVELS, correct
+
+    def format_thresholds(self, thresholds):
+        """Format thresholds in the form ld-chroma-decoder's
+        --transform-thresholds option reads."""
+
+        lines = []
+        thresholds = thresholds.reshape(self.bins_z, self.bins_y, self.bins_x)
+        for z in range(self.bins_z):
+            for y in range(self.bins_y):
+                lines.append("".join("%.4f " % t for t in thresholds[z, y]))
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """Save to a .npz file."""
+
+        # np.savez adds .npz if it's not already there
+        new_filename = filename + ".new.npz"
+        np.savez_compressed(new_filename, dim=self.dim, testcases=np.array(self.testcases, dtype=str),
+                            counts=self.counts, luma=self.luma, chroma=self.chroma,
+                            amp=self.amp, records=self.records)
+        os.rename(new_filename, filename)
+
+    @staticmethod
+    def load(filename):
+        """Load from a .npz file written by save()."""
+
+        with np.load(filename) as data:
+            hist = BinHistogram(str(data["dim"]), [str(t) for t in data["testcases"]])
+            hist.counts = data["counts"]
+            hist.luma = data["luma"]
+            hist.chroma = data["chroma"]
+            hist.amp = data["amp"]
+            hist.records = int(data["records"])
+        return hist
+
+if __name__ == "__main__":
+    import tempfile
+
+    rng = np.random.default_rng(42)
+
+    def make_records(num_records, num_bins):
+        comp = rng.exponential(1.0, (num_records, num_bins, 2)).astype(np.float32)
+        luma = rng.exponential(1.0, (num_records, num_bins, 2)).astype(np.float32)
+        chroma = rng.exponential(1.0, (num_records, num_bins, 2)).astype(np.float32)
+        # Some empty bins
+        comp[:, 0, :] = 0.0
+        return comp, luma, chroma
+
+    def brute_force(comp, luma, chroma, threshold):
+        """Simulate the decoder's test, as calibrate-bins does."""
+
+        luma_mag = np.sqrt(luma.astype(np.float64)).sum(axis=2)
+        chroma_mag = np.sqrt(chroma.astype(np.float64)).sum(axis=2)
+        comp = comp.astype(np.float64)
+        t_sq = threshold * threshold
+        is_luma = (comp[:, :, 0] < comp[:, :, 1] * t_sq) | (comp[:, :, 1] < comp[:, :, 0] * t_sq)
+        return np.where(is_luma, chroma_mag, luma_mag).sum(axis=0)
+
+    print("Testing BinHistogram against brute force")
+    hist = BinHistogram("2d", ["a"])
+    comp, luma, chroma = make_records(500, hist.num_bins)
+    hist.add_records(comp, luma, chroma)
+    thresholds, correct = hist.best_thresholds()
+    for bin in range(hist.num_bins):
+        grid = np.arange(LEVELS + 1) / LEVELS
+        # Avoid thresholds that land exactly on a level boundary, where
+        # floating-point rounding makes the comparison ambiguous
+        incorrect = [brute_force(comp[:, bin:bin + 1], luma[:, bin:bin + 1], chroma[:, bin:bin + 1],
+                                 t - 1e-9 if t > 0 else t)[0]
+                     for t in grid]
+        expected = np.min(incorrect)
+        got = incorrect[int(round(thresholds[bin] * LEVELS))]
+        assert abs(got - expected) <= 1e-6 * expected, (bin, got, expected)
+    assert thresholds[0] == 0.0
+
+    print("Testing merging")
+    hist2 = BinHistogram("2d", ["b"])
+    comp2, luma2, chroma2 = make_records(300, hist2.num_bins)
+    hist2.add_records(comp2, luma2, chroma2)
+    combined = BinHistogram("2d", ["a", "b"])
+    combined.add_records(np.concatenate([comp, comp2]), np.concatenate([luma, luma2]),
+                         np.concatenate([chroma, chroma2]))
+    hist.merge(hist2)
+    assert hist.testcases == ["a", "b"]
+    assert np.array_equal(hist.counts, combined.counts)
+    assert np.allclose(hist.luma, combined.luma)
+    assert np.allclose(hist.chroma, combined.chroma)
+    assert hist.records == 800
+    try:
+        hist.merge(hist2)
+        assert False, "merging the same testcase twice should fail"
+    except ValueError:
+        pass
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print("Testing add_files")
+        filenames = []
+        for name, data in zip(("comp", "luma", "chroma"), (comp, luma, chroma)):
+            filenames.append(os.path.join(tmpdir, name))
+            data.tofile(filenames[-1])
+        # Use several chunks
+        CHUNK_RECORDS = 128
+        from_files = BinHistogram("2d")
+        from_files.add_files(*filenames)
+        expected = BinHistogram("2d")
+        expected.add_records(comp, luma, chroma)
+        assert from_files.records == 500
+        assert np.array_equal(from_files.counts, expected.counts)
+        assert np.allclose(from_files.luma, expected.luma)
+
+        print("Testing save/load")
+        filename = os.path.join(tmpdir, "test.npz")
+        hist.save(filename)
+        loaded = BinHistogram.load(filename)
+        assert loaded.dim == "2d" and loaded.testcases == ["a", "b"] and loaded.records == 800
+        assert np.array_equal(loaded.counts, hist.counts)
+        assert np.array_equal(loaded.best_thresholds()[0], hist.best_thresholds()[0])
+
+    text = hist.format_thresholds(hist.best_thresholds()[0])
+    assert len(text.split("\n")) == 16 + 1 + 1
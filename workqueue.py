@@ -0,0 +1,364 @@
+#!/usr/bin/python3
+# A simple work queue for spreading evaluations across several machines.
+#
+# The optimiser runs a Coordinator, which serves jobs over HTTP. Workers on
+# any machine that can reach it lease a job, run it, and post the result
+# back. A lease has to be renewed while the job is running (the worker does
+# this in the background); if it expires, because the worker has died or lost
+# its connection, the job is given to another worker. Jobs that fail are
+# retried up to a limit.
+#
+# Jobs are identified by a string ID, which should be derived from everything
+# that affects the result, so submitting the same job twice, or getting two
+# results for it (from a worker whose lease expired but which finished
+# anyway), is harmless.
+#
+# The protocol is JSON in POST requests:
+#   /lease  {"worker": NAME}                  -> {"job": ID or null, "payload": ..., "lease": TOKEN, "lease_time": SECONDS}
+#   /renew  {"job": ID, "lease": TOKEN}       -> {"ok": BOOL}
+#   /result {"job": ID, "lease": TOKEN, "result": ...} or {..., "error": MESSAGE} -> {"ok": true}
+# GET /status returns the number of jobs queued and leased, and GET /info
+# returns a description of the coordinator's setup, so workers can check
+# they're compatible before taking any jobs.
+#
+# Running this module as a script will run some self-tests.
+
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import socket
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+import uuid
+
+# How long a worker has to renew its lease, in seconds
+DEFAULT_LEASE_TIME = 120.0
+# How many times to try a job before giving up
+DEFAULT_MAX_ATTEMPTS = 3
+
+class JobFailed(Exception):
+    """A job failed on every attempt."""
+
+class Job:
+    """A job known to the Coordinator."""
+
+    def __init__(self, job_id, payload):
+        self.id = job_id
+        self.payload = payload
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+        self.errors = []
+
+        # The current lease, if the job is leased
+        self.lease = None
+        self.expires = None
+        self.worker = None
+
+class Coordinator:
+    """Serve jobs to workers over HTTP.
+
+    submit() returns a concurrent.futures.Future, so this can be used in
+    place of an Executor by code that collects results from futures."""
+
+    def __init__(self, port, host="", info=None, lease_time=DEFAULT_LEASE_TIME,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.info = info
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+        self.lock = threading.Lock()
+        # All unfinished jobs, by ID
+        self.jobs = {}
+        # IDs of jobs waiting to be leased
+        self.queue = collections.deque()
+        # Leased jobs, by ID
+        self.leased = {}
+
+        coordinator = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/status":
+                    self.reply(coordinator.status())
+                elif self.path == "/info":
+                    self.reply(coordinator.info)
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                handlers = {
+                    "/lease": coordinator.handle_lease,
+                    "/renew": coordinator.handle_renew,
+                    "/result": coordinator.handle_result,
+                    }
+                func = handlers.get(self.path)
+                if func is None:
+                    self.send_error(404)
+                    return
+                try:
+                    length = int(self.headers["Content-Length"])
+                    request = json.loads(self.rfile.read(length))
+                    response = func(request)
+                except (KeyError, TypeError, ValueError) as e:
+                    self.send_error(400, str(e))
+                    return
+                self.reply(response)
+
+            def reply(self, response):
+                data = json.dumps(response).encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logging.debug("%s: %s", self.address_string(), format % args)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info("Coordinator listening on port %d", self.port)
+
+    def submit(self, job_id, payload):
+        """Add a job, unless it's already waiting or running. Return a Future
+        for its result."""
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                job = Job(job_id, payload)
+                self.jobs[job_id] = job
+                self.queue.append(job_id)
+            return job.future
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def status(self):
+        with self.lock:
+            return {
+                "queued": len(self.queue),
+                "leased": len(self.leased),
+                "workers": sorted(set(job.worker for job in self.leased.values())),
+                }
+
+    def retry(self, job, reason):
+        """Put a job back on the queue, or fail it if it's run out of
+        attempts. Called with the lock held."""
+
+        job.errors.append(reason)
+        job.lease = None
+        self.leased.pop(job.id, None)
+        if job.attempts >= self.max_attempts:
+            logging.warning("Job %s failed %d times, giving up: %s", job.id, job.attempts, reason)
+            del self.jobs[job.id]
+            job.future.set_exception(JobFailed("%s: %s" % (job.id, "; ".join(job.errors))))
+        else:
+            logging.info("Retrying job %s: %s", job.id, reason)
+            # Retries go to the front, so a lost job doesn't wait behind
+            # everything submitted since
+            self.queue.appendleft(job.id)
+
+    def expire_leases(self):
+        """Requeue jobs whose leases have expired. Called with the lock held."""
+
+        now = time.monotonic()
+        for job in list(self.leased.values()):
+            if job.expires < now:
+                self.retry(job, "lease expired on %s" % job.worker)
+
+    def handle_lease(self, request):
+        worker = str(request["worker"])
+        with self.lock:
+            self.expire_leases()
+            while self.queue:
+                job = self.jobs[self.queue.popleft()]
+                if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+                    # Cancelled before it started
+                    del self.jobs[job.id]
+                    continue
+
+                job.attempts += 1
+                job.lease = uuid.uuid4().hex
+                job.expires = time.monotonic() + self.lease_time
+                job.worker = worker
+                self.leased[job.id] = job
+                return {
+                    "job": job.id,
+                    "payload": job.payload,
+                    "lease": job.lease,
+                    "lease_time": self.lease_time,
+                    }
+        return {"job": None}
+
+    def handle_renew(self, request):
+        with self.lock:
+            job = self.leased.get(request["job"])
+            if job is None or job.lease != request["lease"]:
+                return {"ok": False}
+            job.expires = time.monotonic() + self.lease_time
+            return {"ok": True}
+
+    def handle_result(self, request):
+        with self.lock:
+            job = self.jobs.get(request["job"])
+            if job is None:
+                # Already finished -- this is a duplicate
+                return {"ok": True}
+
+            if "error" in request:
+                # Ignore errors from workers that have lost their lease; the
+                # job's been given to someone else
+                if job.lease == request["lease"]:
+                    self.retry(job, "%s: %s" % (job.worker, request["error"]))
+                return {"ok": True}
+
+            # A result is good whether or not the lease is still current
+            del self.jobs[job.id]
+            self.leased.pop(job.id, None)
+            try:
+                self.queue.remove(job.id)
+            except ValueError:
+                pass
+        job.future.set_result(request["result"])
+        return {"ok": True}
+
+def get(url, path, timeout=60.0):
+    with urllib.request.urlopen(url.rstrip("/") + path, timeout=timeout) as f:
+        return json.load(f)
+
+def post(url, path, request, timeout=60.0):
+    data = json.dumps(request).encode("UTF-8")
+    req = urllib.request.Request(url.rstrip("/") + path, data=data,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as f:
+        return json.load(f)
+
+def run_worker(url, handler, name=None, poll_interval=5.0, stop=None):
+    """Lease jobs from the coordinator at url, and run handler(payload) for
+    each one, posting back its (JSON-serialisable) result. If handler raises
+    an exception, the error is reported, and the job will be retried.
+
+    This runs until stop (a threading.Event) is set, or forever if stop is
+    None. Losing the connection to the coordinator isn't fatal; the worker
+    waits and tries again."""
+
+    if name is None:
+        name = "%s-%s" % (socket.gethostname(), uuid.uuid4().hex[:8])
+    if stop is None:
+        stop = threading.Event()
+
+    while not stop.is_set():
+        try:
+            response = post(url, "/lease", {"worker": name})
+        except (OSError, ValueError) as e:
+            logging.warning("Can't get a job from %s: %s", url, e)
+            stop.wait(poll_interval)
+            continue
+
+        job_id = response["job"]
+        if job_id is None:
+            stop.wait(poll_interval)
+            continue
+        lease = response["lease"]
+        logging.info("Running job %s", job_id)
+
+        # Keep the lease alive while the handler runs
+        done = threading.Event()
+        def renew():
+            while not done.wait(response["lease_time"] / 3):
+                try:
+                    if not post(url, "/renew", {"job": job_id, "lease": lease})["ok"]:
+                        logging.warning("Lost the lease on job %s", job_id)
+                except (OSError, ValueError) as e:
+                    logging.warning("Can't renew lease on job %s: %s", job_id, e)
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+
+        try:
+            report = {"job": job_id, "lease": lease, "result": handler(response["payload"])}
+        except Exception as e:
+            logging.warning("Job %s failed: %s", job_id, traceback.format_exc())
+            report = {"job": job_id, "lease": lease, "error": "%s: %s" % (e.__class__.__name__, e)}
+        finally:
+            done.set()
+            renewer.join()
+
+        # Keep trying to report the result, since it may have been expensive
+        # to compute
+        while True:
+            try:
+                post(url, "/result", report)
+                break
+            except (OSError, ValueError) as e:
+                logging.warning("Can't report job %s: %s", job_id, e)
+                if stop.wait(poll_interval):
+                    break
+
+if __name__ == "__main__":
+    # The failures here are deliberate
+    logging.basicConfig(level=logging.CRITICAL)
+
+    print("Testing Coordinator with several workers")
+    coordinator = Coordinator(0, host="127.0.0.1", info={"version": 1},
+                              lease_time=1.0, max_attempts=2)
+    url = "http://127.0.0.1:%d" % coordinator.port
+
+    fail_counts = collections.Counter()
+    def handler(payload):
+        if payload.get("fail"):
+            fail_counts[payload["n"]] += 1
+            if payload["fail"] == "always" or fail_counts[payload["n"]] == 1:
+                raise ValueError("failing on purpose")
+        if payload.get("slow"):
+            # Longer than the lease time, so this needs renewing
+            time.sleep(2.5)
+        return payload["n"] * 2
+
+    futures = {n: coordinator.submit("job%d" % n, {"n": n}) for n in range(20)}
+    futures[20] = coordinator.submit("job20", {"n": 20, "fail": "once"})
+    futures[21] = coordinator.submit("job21", {"n": 21, "fail": "always"})
+    futures[22] = coordinator.submit("job22", {"n": 22, "slow": True})
+    # Resubmitting is harmless
+    assert coordinator.submit("job3", {"n": 3}) is futures[3]
+
+    # A worker that leases a job and then disappears
+    lost = post(url, "/lease", {"worker": "lost"})
+    assert lost["job"] is not None
+
+    stop = threading.Event()
+    workers = [threading.Thread(target=run_worker, args=(url, handler),
+                                kwargs={"poll_interval": 0.1, "stop": stop})
+               for i in range(4)]
+    for worker in workers:
+        worker.start()
+
+    for n, future in futures.items():
+        if n == 21:
+            try:
+                future.result(timeout=30)
+                assert False, "job21 should have failed"
+            except JobFailed:
+                pass
+        else:
+            assert future.result(timeout=30) == n * 2
+
+    # A late result from the lost worker is ignored
+    assert post(url, "/result", {"job": lost["job"], "lease": lost["lease"], "result": -1})["ok"]
+    assert post(url, "/renew", {"job": lost["job"], "lease": lost["lease"]})["ok"] is False
+
+    status = get(url, "/status")
+    assert status["queued"] == 0 and status["leased"] == 0
+    assert get(url, "/info") == {"version": 1}
+
+    stop.set()
+    for worker in workers:
+        worker.join()
+    coordinator.shutdown()